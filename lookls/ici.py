@@ -1,11 +1,79 @@
+import asyncio
+import logging
+import threading
 import plyvel
 import aiohttp
-from typing import Any
-import orjson as json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import msgspec
+import zstandard as zstd
+from types import MappingProxyType
+
+
+_EXTBL_EN = MappingProxyType(
+    {
+        "word_pl": "Plural Form",
+        "word_past": "Past Tense",
+        "word_done": "Past Participle",
+        "word_ing": "Present Participle",
+        "word_third": "Simple Present",
+        "word_er": "Comparative Degree",
+        "word_est": "Superlative",
+    }
+)
+_EXTBL_ZH = MappingProxyType(
+    {
+        "word_pl": "复数",
+        "word_ing": "现在分词",
+        "word_done": "过去分词",
+        "word_past": "过去式",
+        "word_third": "第三人称单数",
+        "word_er": "比较级",
+        "word_est": "最高级",
+    }
+)
+_EXCHANGE_HEADER = "\n\n- 词态变化:".encode()
+
+logger = logging.getLogger(__name__)
+
+
+class Part(msgspec.Struct):
+    part: str = ""
+    means: list[str] = []
+
+
+class Symbol(msgspec.Struct):
+    ph_am: str | None = None
+    ph_en: str | None = None
+    parts: list[Part] = []
+
+
+class Sent(msgspec.Struct):
+    orig: str = ""
+    trans: str = ""
+
+
+class IciResponse(msgspec.Struct):
+    word_name: str | None = None
+    symbols: list[Symbol] = []
+    # iciba sends "" rather than [] for forms a word does not have
+    exchange: dict[str, list[str] | str | None] = {}
+    sent: list[Sent] = []
+
+
+_DECODER = msgspec.json.Decoder(IciResponse)
 
 
 class ICIFetcher:
     _URL: str = "http://dict-co.iciba.com/api/dictionary.php"
+    _LLDB_WORKERS: int = 4
+    _MEMO_SIZE: int = 2048
+    _FLUSH_INTERVAL: float = 30.0
+    _LLDB_RETRY: float = 60.0
+    # leads compressed values; uncompressed ones start with "{" or "#"
+    _ZSTD_TAG: bytes = b"\x01"
+    # rendered markdown lives next to the raw json under this key prefix
+    _MARKDOWN_PREFIX: bytes = b"m:"
 
     def __init__(
         self,
@@ -14,114 +82,313 @@ class ICIFetcher:
     ):
         self.__key = ici_key
         self.__cache_lldb = cache_lldb
+        # opened on first use, see __lldb
+        self.__db: plyvel.DB | None = None
+        self.__db_open: asyncio.Future | None = None
+        self.__db_retry_at = 0.0
+        self.__closed = False
+        self.__close_lock = threading.Lock()
+        self.__executor = ThreadPoolExecutor(
+            max_workers=ICIFetcher._LLDB_WORKERS, thread_name_prefix="lldb"
+        )
+        self.__memo: OrderedDict[str, str] = OrderedDict()
+        self.__session: aiohttp.ClientSession | None = None
+        self.__dirty = False
+        self.__flush_task: asyncio.Task | None = None
+        # zstd contexts are not thread-safe, only use them on the loop thread
+        self.__zstd_c = zstd.ZstdCompressor(level=3)
+        self.__zstd_d = zstd.ZstdDecompressor()
 
-    async def __lldb_get(self, key: bytes) -> bytes:
-        with plyvel.DB(self.__cache_lldb, create_if_missing=True) as db:
-            return db.get(key)
+    def close(self) -> None:
+        # safe from any thread and more than once; lookls_main calls it after
+        # the loop is gone, since pygls exits without awaiting the shutdown
+        with self.__close_lock:
+            self.__closed = True
+            self.__executor.shutdown(wait=True)
+            if self.__db is not None and not self.__db.closed:
+                if self.__dirty:
+                    self.__dirty = False
+                    self.__lldb_sync()
+                self.__db.close()
+
+    async def aclose(self) -> None:
+        self.__closed = True
+        if self.__session is not None:
+            await self.__session.close()
+        if self.__flush_task is not None:
+            self.__flush_task.cancel()
+        # waiting on the cache threads would block the loop
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    async def __run_blocking(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.__executor, func, *args
+        )
+
+    def __lldb_open(self) -> plyvel.DB:
+        # stored from the worker thread so that close() also sees a handle
+        # whose open was still in flight
+        self.__db = plyvel.DB(
+            self.__cache_lldb,
+            create_if_missing=True,
+            # large enough to keep a read-mostly dictionary cache in memory
+            lru_cache_size=32 * 1024 * 1024,
+            write_buffer_size=8 * 1024 * 1024,
+            max_open_files=256,
+        )
+        return self.__db
+
+    def __lldb_opened(self, future: asyncio.Future) -> None:
+        # runs before any waiter resumes, whether or not those were cancelled
+        self.__db_open = None
+        if future.cancelled():
+            return
+        if isinstance(e := future.exception(), plyvel.IOError):
+            self.__db_retry_at = (
+                asyncio.get_running_loop().time() + ICIFetcher._LLDB_RETRY
+            )
+            logger.warning("LevelDB cache unavailable, running uncached: %s", e)
+
+    async def __lldb(self) -> plyvel.DB | None:
+        # LevelDB allows a single process per database; while another lookls
+        # or ici holds the lock, run uncached and retry every _LLDB_RETRY
+        if self.__closed:
+            return None
+        if self.__db is not None:
+            return self.__db
+        if self.__db_open is None:
+            loop = asyncio.get_running_loop()
+            if loop.time() < self.__db_retry_at:
+                return None
+            # one open shared by every caller, shielded so that a cancelled
+            # hover does not drop the handle
+            self.__db_open = loop.run_in_executor(self.__executor, self.__lldb_open)
+            self.__db_open.add_done_callback(self.__lldb_opened)
+        try:
+            await asyncio.shield(self.__db_open)
+        except plyvel.IOError:
+            return None
+        return None if self.__closed else self.__db
+
+    @staticmethod
+    def __lldb_load(reader, key: bytes) -> tuple[bytes | None, bytes | None]:
+        markdown = reader.get(ICIFetcher._MARKDOWN_PREFIX + key)
+        if markdown is not None:
+            return markdown, None
+        return None, reader.get(key)
+
+    @staticmethod
+    def __lldb_load_many(
+        db: plyvel.DB, keys: list[bytes]
+    ) -> list[tuple[bytes | None, bytes | None]]:
+        with db.snapshot() as snapshot:
+            return [ICIFetcher.__lldb_load(snapshot, key) for key in keys]
 
-    async def __lldb_put(self, key: bytes, value: bytes) -> None:
-        with plyvel.DB(self.__cache_lldb, create_if_missing=True) as db:
-            db.put(key, value, sync=True)
+    def __lldb_write(self, items: list[tuple[bytes, bytes]]) -> None:
+        # a lost dictionary entry is simply fetched again, so skip the fsync
+        # here and let __flush_loop sync the log every _FLUSH_INTERVAL
+        with self.__db.write_batch(sync=False) as wb:
+            for key, value in items:
+                wb.put(key, value)
+
+    def __lldb_sync(self) -> None:
+        # an empty synchronous batch fsyncs everything logged before it
+        self.__db.write_batch(sync=True).write()
+
+    async def __flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(ICIFetcher._FLUSH_INTERVAL)
+            if self.__dirty:
+                self.__dirty = False
+                await self.__run_blocking(self.__lldb_sync)
+
+    async def __lldb_get(self, key: bytes) -> tuple[bytes | None, bytes | None]:
+        db = await self.__lldb()
+        if db is None:
+            return None, None
+        return await self.__run_blocking(self.__lldb_load, db, key)
+
+    async def __lldb_get_many(
+        self, keys: list[bytes]
+    ) -> list[tuple[bytes | None, bytes | None]]:
+        db = await self.__lldb()
+        if db is None:
+            return [(None, None)] * len(keys)
+        return await self.__run_blocking(self.__lldb_load_many, db, keys)
+
+    def __pack(self, value: bytes) -> bytes:
+        return ICIFetcher._ZSTD_TAG + self.__zstd_c.compress(value)
+
+    def __unpack(self, value: bytes | None) -> bytes | None:
+        if value is None or not value.startswith(ICIFetcher._ZSTD_TAG):
+            return value
+        return self.__zstd_d.decompress(value[1:])
+
+    async def __lldb_put(self, items: list[tuple[bytes, bytes]]) -> None:
+        if await self.__lldb() is None:
+            return
+        items = [(key, self.__pack(value)) for key, value in items]
+        await self.__run_blocking(self.__lldb_write, items)
+        self.__dirty = True
+        if self.__flush_task is None:
+            self.__flush_task = asyncio.create_task(self.__flush_loop())
 
     async def __ici_get(self, word: str) -> bytes:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                url=ICIFetcher._URL,
-                params={"type": "json", "key": self.__key, "w": word},
-            ) as res:
-                return await res.read()
+        # the session binds to the running loop, so it cannot be built in __init__
+        if self.__session is None:
+            self.__session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=8, ttl_dns_cache=300)
+            )
+        async with self.__session.get(
+            url=ICIFetcher._URL,
+            params={"type": "json", "key": self.__key, "w": word},
+        ) as res:
+            return await res.read()
 
-    async def translate(self, word: str) -> str | None:
-        word = word.lower()
-        data: bytes = await self.__lldb_get(word.encode())
-        if data:
-            return "\n".join(self.parse(json.loads(data)))
+    def __memo_get(self, word: str) -> str | None:
+        text = self.__memo.get(word)
+        if text is not None:
+            self.__memo.move_to_end(word)
+        return text
 
+    def __memo_put(self, word: str, text: str) -> None:
+        self.__memo[word] = text
+        self.__memo.move_to_end(word)
+        if len(self.__memo) > ICIFetcher._MEMO_SIZE:
+            self.__memo.popitem(last=False)
+
+    async def __restore(
+        self, word: str, markdown: bytes | None, data: bytes | None
+    ) -> str | None:
+        markdown, data = self.__unpack(markdown), self.__unpack(data)
+        if markdown is not None:
+            text = markdown.decode()
+        elif data:
+            # entry cached before markdown was stored, render and upgrade it
+            markdown = bytes(self.parse(_DECODER.decode(data)))
+            await self.__lldb_put(
+                [(ICIFetcher._MARKDOWN_PREFIX + word.encode(), markdown)]
+            )
+            text = markdown.decode()
+        else:
+            return None
+        self.__memo_put(word, text)
+        return text
+
+    async def __fetch(self, word: str) -> str | None:
         data = await self.__ici_get(word)
-        content = json.loads(data)
-        word_name: str = content.get("word_name")
+        content = _DECODER.decode(data)
+        word_name = content.word_name
         if not word_name:
             return None
-        await self.__lldb_put(word_name.encode(), data)
-        return "\n".join(self.parse(content))
+        markdown = bytes(self.parse(content))
+        key = word_name.encode()
+        await self.__lldb_put(
+            [(key, data), (ICIFetcher._MARKDOWN_PREFIX + key, markdown)]
+        )
+        text = markdown.decode()
+        self.__memo_put(word, text)
+        return text
+
+    async def translate(self, word: str) -> str | None:
+        word = word.lower()
+        text = self.__memo_get(word)
+        if text is not None:
+            return text
+
+        text = await self.__restore(word, *await self.__lldb_get(word.encode()))
+        if text is not None:
+            return text
+
+        return await self.__fetch(word)
+
+    async def translate_many(
+        self, words: list[str]
+    ) -> list[str | None | Exception]:
+        # a word that fails yields its exception, the rest still resolve
+        words = [word.lower() for word in words]
+        results = [self.__memo_get(word) for word in words]
+        misses = [i for i, text in enumerate(results) if text is None]
+        if not misses:
+            return results
+
+        entries = await self.__lldb_get_many([words[i].encode() for i in misses])
+        remote = []
+        for i, entry in zip(misses, entries):
+            try:
+                results[i] = await self.__restore(words[i], *entry)
+            except Exception as e:
+                results[i] = e
+            if results[i] is None:
+                remote.append(i)
+
+        pending = list(dict.fromkeys(words[i] for i in remote))
+        fetched = dict(
+            zip(
+                pending,
+                await asyncio.gather(
+                    *(self.__fetch(w) for w in pending), return_exceptions=True
+                ),
+            )
+        )
+        for i in remote:
+            results[i] = fetched[words[i]]
+        return results
 
     @staticmethod
-    def parse_symbols_part(p) -> str:
-        return "`{}`: {}".format(p["part"], "; ".join(p["means"]))
+    def parse_symbols_part(p: Part) -> str:
+        return f"`{p.part}`: {'; '.join(p.means)}"
 
     @staticmethod
-    def parse_symbol(s) -> list[str]:
+    def parse_symbol(s: Symbol) -> list[str]:
         lines = []
         lines.append(
-            "US: {}; UK: {}".format(s["ph_am"], s["ph_en"]),
+            f"US: {s.ph_am}; UK: {s.ph_en}",
         )
-        for p in s["parts"]:
+        for p in s.parts:
             lines.append(ICIFetcher.parse_symbols_part(p))
 
         return lines
 
     @staticmethod
     def parse_exchange(e) -> str:
-        x = {
-            "word_pl": "Plural Form",
-            "word_past": "Past Tense",
-            "word_done": "Past Participle",
-            "word_ing": "Present Participle",
-            "word_third": "Simple Present",
-            "word_er": "Comparative Degree",
-            "word_est": "Superlative",
-        }
-        return ";".join("{}: {}".format(x[k], ",".join(v)) for k, v in e.items() if v)
+        return ";".join(f"{_EXTBL_EN[k]}: {','.join(v)}" for k, v in e.items() if v)
 
     @staticmethod
-    def parse(data: dict[str, Any]) -> list[str]:
-        try:
-            lines = ["### {}".format(data.get("word_name"))]
-        except Exception:
-            return [""]
+    def parse(data: IciResponse, out: bytearray | None = None) -> bytearray:
+        # lines are written with a leading "\n", matching a "\n".join of them
+        if out is None:
+            out = bytearray()
+        out += f"### {data.word_name}".encode()
 
-        # lines.append(ICIFetcher.parse_exchange(data["exchange"]))
-        # for s in data["symbols"]:
+        # lines.append(ICIFetcher.parse_exchange(data.exchange))
+        # for s in data.symbols:
         #     lines += ICIFetcher.parse_symbol(s)
         # return lines
 
-        for symbol in data.get("symbols", []):
-            lines.append("")
+        for symbol in data.symbols:
+            out += b"\n"
             ph = "-"
-            if symbol.get("ph_am"):
-                ph += " US:\\[{}\\]".format(symbol.get("ph_am"))
+            if symbol.ph_am:
+                ph += f" US:\\[{symbol.ph_am}\\]"
 
-            if symbol.get("ph_en"):
-                ph += " UK:\\[{}\\]".format(symbol.get("ph_en"))
+            if symbol.ph_en:
+                ph += f" UK:\\[{symbol.ph_en}\\]"
 
             if len(ph) > 1:
-                lines.append(ph)
-
-            for part in symbol["parts"]:
-                lines.append("\t- " + ICIFetcher.parse_symbols_part(part))
-
-        extbl = {
-            "word_pl": "复数",
-            "word_ing": "现在分词",
-            "word_done": "过去分词",
-            "word_past": "过去式",
-            "word_third": "第三人称单数",
-            "word_er": "比较级",
-            "word_est": "最高级",
-        }
-        exchange_lines = []
-        for k, v in data.get("exchange", {}).items():
-            if v:
-                exchange_lines.append("\t- {}: {}".format(extbl[k], "; ".join(v)))
+                out += f"\n{ph}".encode()
 
-        if exchange_lines:
-            lines.append("")
-            lines.append("- 词态变化:")
-            lines += exchange_lines
+            for part in symbol.parts:
+                out += f"\n\t- {ICIFetcher.parse_symbols_part(part)}".encode()
 
-        for sent in data.get("sent", []):
-            lines.append("> {}".format(sent["orig"]))
-            lines.append("> {}".format(sent["trans"]))
-            lines.append("")
+        exchange_header = _EXCHANGE_HEADER
+        for k, v in data.exchange.items():
+            if v:
+                out += exchange_header
+                exchange_header = b""
+                out += f"\n\t- {_EXTBL_ZH[k]}: {'; '.join(v)}".encode()
 
-        return lines
+        for sent in data.sent:
+            out += f"\n> {sent.orig}\n> {sent.trans}\n".encode()
+
+        return out
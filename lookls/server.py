@@ -6,60 +6,177 @@ from pygls.lsp.server import LanguageServer
 from pygls.cli import start_server
 from lsprotocol import types
 import asyncio
-import re
+import bisect
+import functools
+import itertools
 import json
+import string
 import appdirs
+from collections import OrderedDict
+from collections.abc import Iterator
 from .ici import ICIFetcher
 
+try:
+    import marisa_trie
+except ImportError:
+    marisa_trie = None
 
-RE_END_HEAD = re.compile(r"[a-zA-Z]{3,}$")
-RE_END_WORD = re.compile("^[A-Za-z]*")
-RE_START_WORD = re.compile("[A-Za-z]*$")
+
+DEFAULT_DICT_FILE = "/usr/share/dict/words"
+WORD_CHARS = frozenset(string.ascii_letters)
+MIN_HEAD_LEN = 3
 
 
 class LookLS(LanguageServer):
     CONFIG_DIR = appdirs.user_config_dir("lookls")
+    RESOLVE_BATCH_WINDOW = 0.005
+    LOOK_LIMIT = 50
+    HOVER_CACHE_SIZE = 128
 
     @staticmethod
-    def __word_at_position(
-        line: str,
-        server_col: int,
-        re_start_word: re.Pattern[str] = RE_START_WORD,
-        re_end_word: re.Pattern[str] = RE_END_WORD,
-    ):
-        start = line[:server_col]
-        end = line[server_col:]
-        m_start = re_start_word.search(start)
-        m_end = re_end_word.search(end)
-        assert m_start
-        assert m_end
-        return m_start.group() + m_end.group(), m_start.span()[0]
-
-    async def __look(self, prefix: str):
-        return (
-            (
-                await (
-                    await asyncio.create_subprocess_exec(
-                        "look",
-                        "-df",
-                        prefix,
-                        self.__dict_file,
-                        stdout=asyncio.subprocess.PIPE,
-                        stderr=asyncio.subprocess.DEVNULL,
-                        stdin=asyncio.subprocess.DEVNULL,
-                    )
-                ).communicate()
-            )[0]
-            .decode()
-            .splitlines()
-        )
+    def __word_start(line: str, server_col: int) -> int:
+        start = server_col
+        while start > 0 and line[start - 1] in WORD_CHARS:
+            start -= 1
+        return start
+
+    @staticmethod
+    def __word_at_position(line: str, server_col: int) -> tuple[str, int]:
+        # the words are a handful of ASCII letters, too short to amortize `re`
+        size = len(line)
+        if server_col > size:
+            # past the end of the line (virtual space), nothing to look up
+            return "", server_col
+        start = LookLS.__word_start(line, server_col)
+        end = server_col
+        while end < size and line[end] in WORD_CHARS:
+            end += 1
+        return line[start:end], start
+
+    @staticmethod
+    def __read_words(dict_file: str) -> Iterator[str]:
+        try:
+            with open(dict_file, encoding="utf-8", errors="replace") as f:
+                for word in map(str.strip, f):
+                    if word:
+                        yield word.lower()
+        except OSError:
+            return
+
+    def __look(self, prefix: str) -> list[str]:
+        prefix = prefix.lower()
+        if self.__trie is not None:
+            # keys come in the trie's own order, not alphabetically, so past
+            # LOOK_LIMIT matches the words offered differ from the list below
+            return list(
+                itertools.islice(self.__trie.iterkeys(prefix), LookLS.LOOK_LIMIT)
+            )
+
+        words = self.__words
+        i = bisect.bisect_left(words, prefix)
+        end = min(i + LookLS.LOOK_LIMIT, len(words))
+        matches = []
+        while i < end and words[i].startswith(prefix):
+            matches.append(words[i])
+            i += 1
+        return matches
+
+    async def __resolve_batch(self, batch: list[tuple[str, asyncio.Future]]):
+        try:
+            results = await self.__ici.translate_many([w for w, _ in batch])
+        except asyncio.CancelledError:
+            for _, future in batch:
+                future.cancel()
+            raise
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def __resolve_worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.__resolve_queue.get()]
+            deadline = loop.time() + LookLS.RESOLVE_BATCH_WINDOW
+            try:
+                while (timeout := deadline - loop.time()) > 0:
+                    try:
+                        batch.append(
+                            await asyncio.wait_for(
+                                self.__resolve_queue.get(), timeout
+                            )
+                        )
+                    except TimeoutError:
+                        break
+            except asyncio.CancelledError:
+                for _, future in batch:
+                    future.cancel()
+                raise
+
+            # keep collecting while slow (network) lookups of this batch run
+            task = asyncio.create_task(self.__resolve_batch(batch))
+            self.__resolve_batches.add(task)
+            task.add_done_callback(self.__resolve_batches.discard)
+
+    def __discard_inflight(self, uri: str, task: asyncio.Task) -> None:
+        if self.__inflight.get(uri, (None, None))[1] is task:
+            del self.__inflight[uri]
+
+    async def __translate_latest(self, uri: str, word: str) -> str | None:
+        inflight = self.__inflight.get(uri)
+        if inflight is not None and inflight[0] == word:
+            task = inflight[1]
+        else:
+            # the client has moved on, stop fetching the previous word
+            if inflight is not None:
+                inflight[1].cancel()
+            task = asyncio.create_task(self.__ici.translate(word))
+            task.add_done_callback(functools.partial(self.__discard_inflight, uri))
+            self.__inflight[uri] = (word, task)
+
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if asyncio.current_task().cancelling():
+                raise
+            return None
+
+    async def __enqueue_resolve(self, word: str) -> str | None:
+        if self.__resolve_task is None:
+            self.__resolve_task = asyncio.create_task(self.__resolve_worker())
+        future = asyncio.get_running_loop().create_future()
+        self.__resolve_queue.put_nowait((word, future))
+        return await future
 
     def __init__(
         self, ici: ICIFetcher, dict_file: str | None = None, *args, **kwargs
     ) -> None:
         super().__init__(name=self.__class__.__name__, version="0.1.0", *args, **kwargs)
         self.__ici = ici
-        self.__dict_file = dict_file or "/usr/share/dict/words"
+        words = self.__read_words(dict_file or DEFAULT_DICT_FILE)
+        self.__trie = None
+        self.__words: list[str] = []
+        if marisa_trie is not None:
+            # built straight from the file, no Python list of every word
+            self.__trie = marisa_trie.Trie(words)
+        else:
+            self.__words = sorted(set(words))
+        self.__resolve_queue: asyncio.Queue[tuple[str, asyncio.Future]] = (
+            asyncio.Queue()
+        )
+        self.__resolve_task: asyncio.Task | None = None
+        self.__resolve_batches: set[asyncio.Task] = set()
+        self.__hover_cache: OrderedDict[tuple, types.Hover] = OrderedDict()
+        self.__inflight: dict[str, tuple[str, asyncio.Task]] = {}
 
         @self.feature(types.TEXT_DOCUMENT_HOVER)
         async def hover(params: types.HoverParams):
@@ -76,17 +193,27 @@ class LookLS(LanguageServer):
             word, start_col = self.__word_at_position(
                 document.lines[server_position.line],
                 server_position.character,
-                re_start_word=RE_START_WORD,
-                re_end_word=RE_END_WORD,
             )
             if not word:
                 return
 
-            hover_content = await self.__ici.translate(word)
+            # the version makes any edit invalidate the document's entries
+            cache_key = (
+                document_uri,
+                document.version,
+                server_position.line,
+                start_col,
+            )
+            cached = self.__hover_cache.get(cache_key)
+            if cached is not None:
+                self.__hover_cache.move_to_end(cache_key)
+                return cached
+
+            hover_content = await self.__translate_latest(document_uri, word)
             if not hover_content:
                 return
 
-            return types.Hover(
+            result = types.Hover(
                 contents=types.MarkupContent(
                     kind=types.MarkupKind.Markdown,
                     value=hover_content,
@@ -103,6 +230,10 @@ class LookLS(LanguageServer):
                     ),
                 ),
             )
+            self.__hover_cache[cache_key] = result
+            if len(self.__hover_cache) > LookLS.HOVER_CACHE_SIZE:
+                self.__hover_cache.popitem(last=False)
+            return result
 
         @self.feature(
             types.TEXT_DOCUMENT_COMPLETION,
@@ -121,24 +252,24 @@ class LookLS(LanguageServer):
                 document.lines, client_position
             )
 
-            head = document.lines[server_position.line][: server_position.character]
-            if not head:
-                return
-
-            match = RE_END_HEAD.search(head)
-            if not match:
+            line = document.lines[server_position.line]
+            head_end = min(server_position.character, len(line))
+            head_start = self.__word_start(line, head_end)
+            if head_end - head_start < MIN_HEAD_LEN:
                 return
 
+            words = self.__look(line[head_start:head_end])
             return types.CompletionList(
-                is_incomplete=False,
+                # a truncated list must be re-requested as the head grows
+                is_incomplete=len(words) >= LookLS.LOOK_LIMIT,
                 item_defaults=types.CompletionItemDefaults(
                     insert_text_format=types.InsertTextFormat.PlainText,
                     edit_range=types.Range(
                         start=types.Position(
-                            line=server_position.line, character=match.span()[0]
+                            line=server_position.line, character=head_start
                         ),
                         end=types.Position(
-                            line=server_position.line, character=len(head)
+                            line=server_position.line, character=head_end
                         ),
                     ),
                 ),
@@ -147,13 +278,13 @@ class LookLS(LanguageServer):
                         label=i,
                         kind=types.CompletionItemKind.Text,
                     )
-                    for i in await self.__look(match.group())
+                    for i in words
                 ],
             )
 
         @self.feature(types.COMPLETION_ITEM_RESOLVE)
         async def completion_item_resolve(item: types.CompletionItem):
-            hover_content = await self.__ici.translate(item.label)
+            hover_content = await self.__enqueue_resolve(item.label)
             if not hover_content:
                 item.documentation = None
             else:
@@ -163,6 +294,20 @@ class LookLS(LanguageServer):
                 )
             return item
 
+        @self.feature(types.SHUTDOWN)
+        async def shutdown(*args):
+            # let nothing reach the cache once aclose() has closed it
+            tasks = [*self.__resolve_batches]
+            tasks += [task for _, task in self.__inflight.values()]
+            if self.__resolve_task is not None:
+                tasks.append(self.__resolve_task)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            while not self.__resolve_queue.empty():
+                self.__resolve_queue.get_nowait()[1].cancel()
+            await self.__ici.aclose()
+
     @staticmethod
     def load_cfg():
         return json.load(open(os.path.join(LookLS.CONFIG_DIR, "config.json")))
@@ -177,7 +322,11 @@ class LookLS(LanguageServer):
 
 
 async def _ici_translate(word: str):
-    msg = await LookLS.get_ici().translate(word)
+    ici = LookLS.get_ici()
+    try:
+        msg = await ici.translate(word)
+    finally:
+        await ici.aclose()
     if not msg:
         return
     from rich.console import Console
@@ -196,6 +345,12 @@ def ici_main():
 
 def lookls_main():
     logging.basicConfig(level=logging.INFO, format="%(message)s")
-    start_server(
-        LookLS(LookLS.get_ici(), dict_file=os.path.join(LookLS.CONFIG_DIR, "20k.txt"))
-    )
+    dict_file = os.path.join(LookLS.CONFIG_DIR, "20k.txt")
+    if not os.path.isfile(dict_file):
+        dict_file = DEFAULT_DICT_FILE
+    ici = LookLS.get_ici()
+    try:
+        start_server(LookLS(ici, dict_file=dict_file))
+    finally:
+        # pygls exits without waiting for the shutdown handler to finish
+        ici.close()